@@ -1,9 +1,43 @@
 # app.py
 
 import streamlit as st
-import pandas as pd
 import google.generativeai as genai
-import json
+import orjson
+import re
+import io
+import datetime
+import hashlib
+import collections
+import time
+import threading
+import importlib
+import importlib.util
+import sys
+import ast
+import builtins
+import types
+import functools
+import numbers
+from concurrent.futures import ThreadPoolExecutor
+
+def _lazy_import(name):
+    """
+    Returns the module, deferring its actual import until an attribute is first
+    used. Keeps heavy libraries off the cold-start path of the empty app.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+# The Gemini SDK is imported eagerly: the model is built on the first run anyway
+pd = _lazy_import("pandas")
+pio = _lazy_import("plotly.io")
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -15,68 +49,783 @@ st.set_page_config(
 # --- Gemini API Configuration ---
 # NOTE: This is the correct way to configure the API key for deployment.
 # It reads the key from the secrets you set up on Streamlit Community Cloud.
-try:
+# A pinned version, since context caching requires one; the main model and the
+# cached one use the same version so replies don't depend on which path served them.
+MODEL_NAME = "models/gemini-1.5-flash-002"
+
+@st.cache_resource
+def _get_model(api_key_hash):
+    """
+    Configures the API and builds the model once per process, so reruns
+    reuse its client instead of reconnecting. Keyed on a hash of the API
+    key so a rotated key builds a fresh model.
+    """
     genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
-    model = genai.GenerativeModel('gemini-1.5-flash')
+    return genai.GenerativeModel(MODEL_NAME)
+
+try:
+    model = _get_model(hashlib.sha256(st.secrets["GEMINI_API_KEY"].encode()).hexdigest())
 except Exception as e:
     st.error(f"Error configuring the Gemini API: {e}", icon="🚨")
     st.info("Please make sure you have set up your GEMINI_API_KEY in the Streamlit secrets.", icon="🔑")
     st.stop()
 
+# Context caching keeps the role, instructions and data summary on Gemini's side
+# so each turn only sends the conversation and the latest question. The model
+# only caches content of at least CACHE_MIN_TOKENS tokens; since the summary
+# describes a bounded number of columns, in practice only files with thousands
+# of columns (whose names alone fill the summary) reach it, and every other
+# upload is sent uncached.
+CACHE_MIN_TOKENS = 32_768
+CACHE_TTL = datetime.timedelta(minutes=30)
+
+# Replies to repeated questions are served locally instead of calling the API again.
+RESPONSE_CACHE_TTL = 3600  # seconds
+RESPONSE_CACHE_MAX_ENTRIES = 256
+
+# Statistics for larger frames are computed on a random sample of this many rows.
+SUMMARY_SAMPLE_ROWS = 50_000
+
+# Frames wider than this only describe their first numeric and non-numeric columns.
+SUMMARY_MAX_COLUMNS = 20
+SUMMARY_MAX_OTHER_COLUMNS = 5
+
+# Once the history holds more than HISTORY_MAX_MESSAGES, all but the last
+# HISTORY_KEEP_MESSAGES are folded into a short model-written rollup.
+HISTORY_MAX_MESSAGES = 10
+HISTORY_KEEP_MESSAGES = 2
+ROLLUP_INSTRUCTION = """
+    Summarize the conversation below between a user and a data analyst AI in at most 200 tokens.
+    Keep the facts, numbers and conclusions later questions may refer to.
+    """
+
+# After each answer, the likely next question is predicted and answered in the
+# background, then offered as a suggestion that submits exactly that question and
+# is served from the prefetch. Typed questions only use it on a normalized match.
+FOLLOWUP_INSTRUCTION = """
+    Based on the data summary and the conversation so far, predict the single most likely
+    next question the user will ask about this data. Reply with that question only.
+    """
+
+# Generated chart code runs with only these builtins, may only import these exact
+# modules, and may only access the attributes listed below: the charting and
+# data-wrangling API of Plotly, pandas and numpy, with no file I/O or
+# introspection. Anything else is rejected before the code runs.
+SAFE_CHART_BUILTINS = {
+    "abs", "all", "any", "bool", "dict", "enumerate", "filter", "float", "int",
+    "isinstance", "len", "list", "map", "max", "min", "print", "range", "reversed",
+    "round", "set", "sorted", "str", "sum", "tuple", "zip",
+    "Exception", "KeyError", "TypeError", "ValueError",
+}
+ALLOWED_CHART_IMPORTS = {
+    "plotly.express", "plotly.graph_objects", "pandas", "numpy", "math", "datetime",
+}
+ALLOWED_CHART_ATTRIBUTES = {
+    # Plotly modules, express functions and graph objects
+    "express", "graph_objects", "colors", "qualitative", "sequential",
+    "area", "bar", "bar_polar", "box", "density_contour", "density_heatmap", "ecdf",
+    "funnel", "histogram", "icicle", "imshow", "line", "line_polar", "parallel_categories",
+    "parallel_coordinates", "pie", "scatter", "scatter_3d", "scatter_matrix",
+    "scatter_polar", "strip", "sunburst", "timeline", "treemap", "violin",
+    "Figure", "Bar", "Box", "Funnel", "Heatmap", "Histogram", "Indicator", "Pie",
+    "Scatter", "Scatter3d", "Table", "Treemap", "Violin", "Waterfall",
+    "Plotly", "Set1", "Set2", "Pastel", "Viridis", "Blues", "Reds",
+    # Figure methods and properties
+    "add_annotation", "add_hline", "add_hrect", "add_shape", "add_trace", "add_vline",
+    "add_vrect", "data", "for_each_trace", "layout", "title", "update",
+    "update_layout", "update_traces", "update_xaxes", "update_yaxes", "xaxis", "yaxis",
+    # pandas frames, series, grouping and accessors
+    "DataFrame", "Series", "Grouper", "concat", "crosstab", "cut", "date_range", "melt",
+    "merge", "qcut", "to_datetime", "to_numeric", "to_timedelta",
+    "abs", "agg", "aggregate", "all", "any", "apply", "assign", "astype", "between",
+    "clip", "columns", "copy", "corr", "count", "cumsum", "describe", "diff", "drop",
+    "drop_duplicates", "dropna", "dt", "dtypes", "explode", "fillna", "filter",
+    "first", "groupby", "head", "idxmax", "idxmin", "iloc", "index", "isin", "isna",
+    "isnull", "last", "loc", "map", "max", "mean", "median", "min", "name", "nlargest",
+    "notna", "notnull", "nsmallest", "nunique", "pct_change", "pivot", "pivot_table",
+    "quantile", "rank", "rename", "replace", "resample", "reset_index", "rolling",
+    "round", "select_dtypes", "shape", "size", "sort_index", "sort_values", "stack",
+    "std", "str", "sum", "tail", "to_frame", "to_list", "tolist", "transpose",
+    "unique", "unstack", "value_counts", "values", "var", "where", "T",
+    "contains", "endswith", "lower", "split", "startswith", "strip", "upper",
+    "date", "day", "day_name", "dayofweek", "hour", "month", "month_name", "quarter",
+    "strftime", "week", "weekday", "year",
+    # numpy, math and datetime
+    "arange", "array", "corrcoef", "cos", "exp", "inf", "linspace", "log", "log10",
+    "nan", "percentile", "pi", "poly1d", "polyfit", "sin", "sqrt",
+    "datetime", "timedelta",
+    # Builtin container methods
+    "append", "extend", "get", "items", "join", "keys",
+}
+
+# Simple descriptive questions are answered locally with pandas, skipping the API.
+_DATASET = r"(the |this )?(data(set)?|file|csv|table)"
+_ROW_COUNT_RE = re.compile(
+    rf"^how many (rows|records|entries)( are there| (does|do) {_DATASET} have)?( in {_DATASET})?\??$",
+    re.IGNORECASE,
+)
+_COLUMN_COUNT_RE = re.compile(
+    rf"^how many columns( are there| (does|do) {_DATASET} have)?( in {_DATASET})?\??$",
+    re.IGNORECASE,
+)
+_COLUMN_NAMES_RE = re.compile(
+    r"^(what are the |list (all )?(the )?|show (me )?(the )?)?column( name)?s\??$", re.IGNORECASE
+)
+_COLUMN_STAT_RE = re.compile(
+    r"^(what is |what's )?(the )?(?P<stat>mean|average|median|sum|total|max|maximum|min|minimum)"
+    r" (of|for) (the )?(column )?['\"`]?(?P<column>.+?)['\"`]?( column)?\??$",
+    re.IGNORECASE,
+)
+_LOCAL_STATS = {
+    "mean": "mean", "average": "mean", "median": "median", "sum": "sum", "total": "sum",
+    "max": "max", "maximum": "max", "min": "min", "minimum": "min",
+}
+
+# Spans from the first "{" to the last "}", skipping any markdown fences around the JSON.
+_JSON_RE = re.compile(r"\{.*\}", re.DOTALL)
+
+SYSTEM_INSTRUCTION = """
+    You are an expert data analyst AI. Your user has uploaded a CSV file and will ask questions about it.
+    Analyze the data summary and the conversation history to answer the user's latest question.
+
+    **Your Task & Instructions:**
+    1.  Provide a clear, concise text answer to the user's question in the "answer" field.
+    2.  If the question can be better answered with a visualization, generate the necessary Python code to create it using the Plotly library. The dataframe is available as a variable named `df`. Place this code in the "python_code" field.
+    3.  The Python code must create a Plotly figure object named 'fig'. For example: `import plotly.express as px; fig = px.bar(df, ...)`
+    4.  Return your response as a single, valid JSON object with two keys: "answer" (string) and "python_code" (string, or null if no chart is needed).
+    """
+
 
 # --- Helper Functions ---
 
-def get_gemini_response(prompt):
+@st.cache_data(show_spinner=False, max_entries=4)
+def _load_csv(raw_bytes):
+    """
+    Parses the uploaded CSV bytes into an Arrow-backed DataFrame using
+    PyArrow's multithreaded reader.
+    Cached on the file contents so reruns skip re-parsing the same upload.
+    Falls back to pandas for files the stricter Arrow parser rejects.
+    """
+    # Imported here so PyArrow is only loaded once a file is uploaded
+    import pyarrow as pa
+    import pyarrow.csv as pv
+
+    try:
+        table = pv.read_csv(
+            io.BytesIO(raw_bytes),
+            read_options=pv.ReadOptions(use_threads=True, block_size=8 << 20),
+        )
+    except pa.ArrowInvalid:
+        return pd.read_csv(io.BytesIO(raw_bytes), engine="c", low_memory=False)
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _describe_str(df_fingerprint, _df):
+    """
+    Returns the statistical summary of the dataframe as compact CSV text.
+    Keyed on the upload fingerprint so it is computed once per file.
+    Wide frames are limited to their first numeric and non-numeric columns,
+    and statistics are rounded to keep the prompt short. Large frames are
+    described from a sample, with the top values of non-numeric columns
+    listed separately.
+    """
+    numeric_columns = list(_df.select_dtypes("number").columns)
+    other_columns = [column for column in _df.columns if column not in numeric_columns]
+    parts = []
+    if len(_df.columns) > SUMMARY_MAX_COLUMNS:
+        numeric_columns = numeric_columns[:SUMMARY_MAX_COLUMNS]
+        other_columns = other_columns[:SUMMARY_MAX_OTHER_COLUMNS]
+        parts.append(
+            f"(Only the first {len(numeric_columns)} numeric and "
+            f"{len(other_columns)} non-numeric columns are described.)"
+        )
+
+    sampled = len(_df) > SUMMARY_SAMPLE_ROWS
+    stats_source = _df.sample(SUMMARY_SAMPLE_ROWS, random_state=0) if sampled else _df
+    if numeric_columns:
+        parts.append(stats_source[numeric_columns].describe().round(3).to_csv())
+    if other_columns and not sampled:
+        parts.append(_df[other_columns].describe(include="all").to_csv())
+    elif other_columns:
+        # Counting top values stays cheap on the full frame
+        for column in other_columns:
+            top_values = _df[column].value_counts().head(5)
+            parts.append(f"Top values of '{column}':\n{top_values.to_csv()}")
+    return "\n".join(parts)
+
+def upload_fingerprint(raw_bytes):
+    """
+    Returns a hex fingerprint of the uploaded file's bytes. BLAKE2 hashes at
+    memory speed, so covering every byte costs far less than parsing the file,
+    and unlike id(df) it is stable across reruns.
+    """
+    return hashlib.blake2b(raw_bytes, digest_size=16).hexdigest()
+
+def build_data_summary(df, df_fingerprint):
+    """
+    Builds the data summary block embedded in every prompt.
+    """
+    sampled = f", based on a {SUMMARY_SAMPLE_ROWS:,}-row sample" if len(df) > SUMMARY_SAMPLE_ROWS else ""
+    return f"""
+    Here is a summary of the data:
+    - Column Names: {', '.join(df.columns)}
+    - Number of rows: {len(df)}
+    - Data Description (statistical summary{sampled}):
+    {_describe_str(df_fingerprint, df)}
+    """
+
+def create_cached_context(data_summary, df_fingerprint):
+    """
+    Caches the system instruction and data summary on Gemini's side.
+    Keeps the existing cache if it was built for the same data, otherwise
+    deletes the cache of the previous upload first. Skips caching (returning
+    None) when the content is below the model's minimum cacheable size,
+    which is the case for all but very wide files.
+    """
+    if (st.session_state.get("cached_model") is not None
+            and st.session_state.get("cached_content_fingerprint") == df_fingerprint):
+        return st.session_state.cached_content
+    delete_cached_context()
+    contents = [f"**Data Summary:**\n{data_summary}"]
+    # A token is rarely shorter than two characters, so small summaries are
+    # ruled out without asking the API to count them
+    if len(SYSTEM_INSTRUCTION) + len(contents[0]) < CACHE_MIN_TOKENS * 2:
+        return None
+    try:
+        if model.count_tokens([SYSTEM_INSTRUCTION, *contents]).total_tokens < CACHE_MIN_TOKENS:
+            return None
+        cached = genai.caching.CachedContent.create(
+            model=MODEL_NAME,
+            display_name=f"csv-{df_fingerprint}",
+            system_instruction=SYSTEM_INSTRUCTION,
+            contents=contents,
+            ttl=CACHE_TTL,
+        )
+    except Exception:
+        return None
+    st.session_state.cached_content = cached
+    st.session_state.cached_model = genai.GenerativeModel.from_cached_content(cached_content=cached)
+    st.session_state.cached_content_fingerprint = df_fingerprint
+    st.session_state.cached_content_expiry = datetime.datetime.now() + CACHE_TTL
+    return cached
+
+def _forget_cached_context():
+    """
+    Clears the context cache handles from session state without deleting the cache.
+    """
+    st.session_state.cached_content = None
+    st.session_state.cached_model = None
+    st.session_state.cached_content_fingerprint = None
+    st.session_state.cached_content_expiry = None
+
+def delete_cached_context():
+    """
+    Deletes the context cache stored in session state, if any.
+    """
+    cached = st.session_state.get("cached_content")
+    _forget_cached_context()
+    if cached is not None:
+        try:
+            cached.delete()
+        except Exception:
+            pass
+
+def get_active_model():
+    """
+    Returns the model bound to the session's context cache, refreshing the
+    cache's TTL once half of it has elapsed. Falls back to the plain model
+    when there is no cache or it can no longer be refreshed.
+    """
+    cached_model = st.session_state.get("cached_model")
+    if cached_model is None:
+        return model
+    remaining = st.session_state.cached_content_expiry - datetime.datetime.now()
+    if remaining < CACHE_TTL / 2:
+        try:
+            st.session_state.cached_content.update(ttl=CACHE_TTL)
+            st.session_state.cached_content_expiry = datetime.datetime.now() + CACHE_TTL
+        except Exception:
+            # The cache expired or was removed; send the full prompt from now on
+            _forget_cached_context()
+            return model
+    return cached_model
+
+def normalize_question(text):
+    """
+    Lowercases a question and collapses its whitespace, for exact matching.
+    """
+    return " ".join(text.lower().split())
+
+def make_response_key(df_fingerprint, user_question, roles, contents):
+    """
+    Builds the response-cache key from the data fingerprint, the normalized
+    question and the previous user question, so follow-ups that depend on
+    earlier turns don't collide with the same words asked in isolation.
+    """
+    # The latest user message is the question itself, so look one further back
+    user_questions = [content for role, content in zip(roles, contents) if role == "user"]
+    previous = normalize_question(user_questions[-2]) if len(user_questions) > 1 else ""
+    raw_key = f"{df_fingerprint}|{normalize_question(user_question)}|{previous}"
+    return hashlib.blake2b(raw_key.encode()).hexdigest()
+
+def _read_unicode_escape(buffer, i):
+    """
+    Decodes the \\uXXXX escape at buffer[i], joining UTF-16 surrogate pairs.
+    Returns (character, next index), or (None, i) if the escape is still incomplete.
+    """
+    digits = buffer[i + 2:i + 6]
+    if len(digits) < 4:
+        return None, i
+    try:
+        code = int(digits, 16)
+    except ValueError:
+        # Malformed escape; show it as plain text
+        return "u", i + 2
+    if 0xD800 <= code < 0xDC00:
+        low = buffer[i + 6:i + 12]
+        if len(low) < 6:
+            return None, i
+        if low.startswith("\\u"):
+            low_code = int(low[2:], 16)
+            if 0xDC00 <= low_code < 0xE000:
+                return chr(0x10000 + ((code - 0xD800) << 10) + (low_code - 0xDC00)), i + 12
+    return chr(code), i + 6
+
+def extract_answer_prefix(buffer):
+    """
+    Returns the part of the "answer" field received so far in a partial JSON reply,
+    so it can be shown while the rest of the response is still streaming.
+    """
+    key_pos = buffer.find('"answer"')
+    if key_pos == -1:
+        return ""
+    colon = buffer.find(":", key_pos + len('"answer"'))
+    if colon == -1:
+        return ""
+    start = colon + 1
+    while start < len(buffer) and buffer[start].isspace():
+        start += 1
+    # Nothing to show until the value starts, or if it isn't a string (e.g. null)
+    if start >= len(buffer) or buffer[start] != '"':
+        return ""
+    escapes = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f", '"': '"', "\\": "\\", "/": "/"}
+    chars = []
+    i = start + 1
+    while i < len(buffer):
+        char = buffer[i]
+        if char == '"':
+            break
+        if char == "\\":
+            if i + 1 >= len(buffer):
+                break
+            if buffer[i + 1] == "u":
+                code, i = _read_unicode_escape(buffer, i)
+                if code is None:
+                    break
+                chars.append(code)
+                continue
+            chars.append(escapes.get(buffer[i + 1], buffer[i + 1]))
+            i += 2
+            continue
+        chars.append(char)
+        i += 1
+    return "".join(chars)
+
+def _import_plotly():
+    """
+    Imports the Plotly modules generated chart code uses.
+    """
+    return importlib.import_module("plotly.express"), importlib.import_module("plotly.graph_objects")
+
+@st.cache_resource
+def _prewarm_plotly():
+    """
+    Imports Plotly on a background thread once per process, so the first
+    generated chart doesn't pay the cold-import cost after the reply arrives.
+    Returns a future resolving to (plotly.express, plotly.graph_objects).
+    """
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="plotly-prewarm")
+    return executor.submit(_import_plotly)
+
+def _check_chart_code(tree):
+    """
+    Rejects generated code that imports anything but ALLOWED_CHART_IMPORTS,
+    imports or accesses a name outside ALLOWED_CHART_ATTRIBUTES, or uses a
+    dunder name.
+    """
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                if alias.name not in ALLOWED_CHART_IMPORTS:
+                    raise ValueError(f"Importing '{alias.name}' is not allowed in generated code.")
+        elif isinstance(node, ast.ImportFrom):
+            if node.level != 0 or node.module not in ALLOWED_CHART_IMPORTS:
+                raise ValueError(f"Importing from '{node.module}' is not allowed in generated code.")
+            for alias in node.names:
+                if alias.name not in ALLOWED_CHART_ATTRIBUTES:
+                    raise ValueError(f"Importing '{alias.name}' is not allowed in generated code.")
+        elif isinstance(node, ast.Name) and node.id.startswith("__"):
+            raise ValueError(f"Using '{node.id}' is not allowed in generated code.")
+        elif isinstance(node, ast.Attribute) and node.attr not in ALLOWED_CHART_ATTRIBUTES:
+            raise ValueError(f"Accessing '{node.attr}' is not allowed in generated code.")
+
+def _chart_import(name, globals=None, locals=None, fromlist=(), level=0):
+    """
+    Stands in for __import__ inside generated code, refusing anything
+    outside ALLOWED_CHART_IMPORTS and any imported name that is itself
+    a module or not in ALLOWED_CHART_ATTRIBUTES.
+    """
+    if level != 0 or name not in ALLOWED_CHART_IMPORTS:
+        raise ImportError(f"Importing '{name}' is not allowed in generated code.")
+    module = __import__(name, globals, locals, fromlist, level)
+    for attribute in fromlist or ():
+        value = getattr(module, attribute, None)
+        if attribute not in ALLOWED_CHART_ATTRIBUTES or isinstance(value, types.ModuleType):
+            raise ImportError(f"Importing '{attribute}' from '{name}' is not allowed in generated code.")
+    return module
+
+def _chart_builtins():
+    """
+    Returns the restricted builtins generated chart code runs with.
+    """
+    chart_builtins = {name: getattr(builtins, name) for name in SAFE_CHART_BUILTINS}
+    chart_builtins["__import__"] = _chart_import
+    return chart_builtins
+
+@functools.lru_cache(maxsize=128)
+def _compile_chart_code(source):
+    """
+    Parses, validates and compiles generated chart code.
+    Cached on the source so repeated charts skip parsing and compilation.
+    """
+    tree = ast.parse(source, filename="<ai>", mode="exec")
+    _check_chart_code(tree)
+    return compile(tree, "<ai>", "exec")
+
+def _generate_response(prompt, active_model, placeholder=None):
+    """
+    Streams the reply from the Gemini API and parses its JSON once complete.
+    The partial answer is rendered into the placeholder as chunks arrive.
+    Raises on failure.
+    """
+    buffer = ""
+    for chunk in active_model.generate_content(prompt, stream=True):
+        buffer += chunk.text
+        if placeholder is not None:
+            placeholder.markdown(extract_answer_prefix(buffer))
+    # Extract the JSON object from the response
+    match = _JSON_RE.search(buffer)
+    if match is None:
+        raise ValueError("The response did not contain a JSON object.")
+    return orjson.loads(match.group(0))
+
+@st.cache_resource
+def _response_cache():
+    """
+    Process-wide store of parsed replies keyed by response-cache key.
+    Held as a resource rather than with st.cache_data because streaming renders
+    into a placeholder created outside the generating function.
+    """
+    return collections.OrderedDict()
+
+@st.cache_resource
+def _response_cache_lock():
+    """
+    Guards the response cache, which every session's script thread updates.
+    """
+    return threading.Lock()
+
+def lookup_cached_response(key):
+    """
+    Returns the cached reply for a response-cache key, or None on a miss.
+    """
+    with _response_cache_lock():
+        cache = _response_cache()
+        entry = cache.get(key)
+        if entry is None or time.monotonic() - entry[0] >= RESPONSE_CACHE_TTL:
+            return None
+        cache.move_to_end(key, last=True)
+        return entry[1]
+
+def _store_cached_response(key, data):
+    """
+    Stores a reply under its response-cache key, evicting the least recently used.
+    """
+    with _response_cache_lock():
+        cache = _response_cache()
+        cache[key] = (time.monotonic(), data)
+        cache.move_to_end(key, last=True)
+        while len(cache) > RESPONSE_CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
+
+def _cached_response(key, prompt, active_model, placeholder=None):
+    """
+    Returns the parsed reply for a response-cache key, calling the API only on a miss.
+    Failures raise, so they are never cached.
+    """
+    data = lookup_cached_response(key)
+    if data is None:
+        data = _generate_response(prompt, active_model, placeholder)
+        _store_cached_response(key, data)
+    return data
+
+def get_gemini_response(prompt, active_model=None, cache_key=None, placeholder=None):
     """
     Sends a prompt to the Gemini API and returns the parsed JSON response.
+    Repeated questions are answered from the response cache when a key is given.
     Handles potential errors during the API call.
     """
     try:
-        response = model.generate_content(prompt)
-        # Clean the response to ensure it's valid JSON
-        cleaned_response = response.text.strip().replace("```json", "").replace("```", "").strip()
-        return json.loads(cleaned_response)
+        if cache_key is not None:
+            return _cached_response(cache_key, prompt, active_model or model, placeholder)
+        return _generate_response(prompt, active_model or model, placeholder)
     except Exception as e:
         st.error(f"An error occurred while communicating with the Gemini API: {e}", icon="🔥")
         return None
 
-def create_prompt(df, user_question, history):
+@st.cache_resource
+def _prefetch_executor():
     """
-    Creates a detailed and structured prompt for the Gemini model,
-    including data summary, conversation history, and instructions.
+    Thread pool shared by all sessions for speculative follow-up answers.
     """
-    # Get a summary of the dataframe
-    data_summary = f"""
-    Here is a summary of the data:
-    - Column Names: {', '.join(df.columns)}
-    - Number of rows: {len(df)}
-    - Data Description (statistical summary):
-    {df.describe(include='all').to_string()}
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="followup-prefetch")
+
+def _prefetch_followup(data_summary, formatted_history, rollup, active_model, send_prefix):
     """
-    
-    # Format the chat history for the prompt
-    formatted_history = "\n".join([f"{msg['role']}: {msg['content']}" for msg in history])
+    Predicts the next question and generates its answer. Runs on the prefetch
+    thread pool, so it must not touch Streamlit; returns
+    (question, response) or raises on failure.
+    """
+    # Predicted with the plain model, which lacks the JSON-answer system instruction
+    prediction = model.generate_content(f"""
+    **Data Summary:**
+    {data_summary}
 
-    prompt = f"""
-    You are an expert data analyst AI. Your user has uploaded a CSV file and will ask questions about it.
-    Analyze the data summary and the conversation history to answer the user's latest question.
+    **Summary of Earlier Conversation:**
+    {rollup}
+
+    **Conversation History:**
+    {formatted_history}
+    {FOLLOWUP_INSTRUCTION}
+    """)
+    question = prediction.text.strip()
+
+    static_prefix, dynamic_suffix = create_prompt(data_summary, question, formatted_history, rollup)
+    full_prompt = static_prefix + dynamic_suffix if send_prefix else dynamic_suffix
+    response = _generate_response(full_prompt, active_model)
+    return question, response
+
+def start_followup_prefetch(active_model):
+    """
+    Starts answering the likely next question in the background and keeps
+    the future in session state, cancelling any prefetch it supersedes.
+    """
+    cancel_prefetch()
+    st.session_state.prefetch = _prefetch_executor().submit(
+        _prefetch_followup,
+        st.session_state.data_summary,
+        st.session_state.history_str,
+        st.session_state.rollup,
+        active_model,
+        active_model is model,
+    )
+
+def cancel_prefetch():
+    """
+    Drops the session's pending prefetch, cancelling it if it hasn't started
+    so stale work doesn't hold up the shared pool or use API quota.
+    """
+    future = st.session_state.get("prefetch")
+    st.session_state.prefetch = None
+    if future is not None:
+        future.cancel()
+
+def prefetched_question():
+    """
+    Returns the predicted next question once its prefetch has finished
+    successfully, or None.
+    """
+    future = st.session_state.get("prefetch")
+    if future is None or not future.done() or future.cancelled() or future.exception() is not None:
+        return None
+    return future.result()[0]
+
+@st.fragment(run_every=1)
+def _await_prefetch():
+    """
+    Polls the pending prefetch and reruns the app once it finishes, so its
+    suggestion shows up without waiting for the user's next action.
+    """
+    future = st.session_state.get("prefetch")
+    if future is None or future.done():
+        st.rerun()
+
+def take_prefetched_response(user_question):
+    """
+    Returns the prefetched response if it has finished and its predicted
+    question is the user's question after normalization. The pending
+    prefetch is consumed either way; one still running is discarded rather
+    than waited on.
+    """
+    future = st.session_state.get("prefetch")
+    cancel_prefetch()
+    if future is None or not future.done() or future.cancelled():
+        return None
+    try:
+        question, response = future.result()
+    except Exception:
+        return None
+    if normalize_question(question) != normalize_question(user_question):
+        return None
+    return response
+
+def _orjson_default(obj):
+    """
+    Converts values orjson doesn't encode natively, such as object-dtype arrays.
+    """
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    raise TypeError
+
+def figure_to_json(fig):
+    """
+    Serializes a Plotly figure to its JSON spec with orjson, encoding numpy
+    arrays natively. Falls back to Plotly's serializer for values orjson
+    can't handle.
+    """
+    try:
+        return orjson.dumps(
+            fig.to_plotly_json(), default=_orjson_default, option=orjson.OPT_SERIALIZE_NUMPY
+        ).decode()
+    except TypeError:
+        return fig.to_json()
+
+@st.cache_resource(max_entries=256)
+def figure_from_json(spec):
+    """
+    Rebuilds a stored chart from its JSON spec once, so reruns redraw the
+    transcript without re-validating every figure.
+    """
+    return pio.from_json(spec)
+
+def add_message(role, content, chart=None):
+    """
+    Appends a message to the chat transcript, stored in session state as
+    parallel role, content and chart lists.
+    """
+    st.session_state.roles.append(role)
+    st.session_state.contents.append(content)
+    st.session_state.charts.append(chart)
+
+def append_history(role, content):
+    """
+    Appends one message to the running history string in session state.
+    """
+    entry = f"\n{role}: {content}"
+    st.session_state.history_str += entry
+    st.session_state.history_lengths.append(len(entry))
+
+def roll_up_history():
+    """
+    Once the history holds more than HISTORY_MAX_MESSAGES, folds all but the
+    last HISTORY_KEEP_MESSAGES into the rollup summary in session state, so
+    the prompt stays bounded on long sessions. If the summary call fails, the
+    older messages are dropped instead.
+    """
+    lengths = st.session_state.history_lengths
+    if len(lengths) <= HISTORY_MAX_MESSAGES:
+        return
+    cut = sum(lengths[:-HISTORY_KEEP_MESSAGES])
+    older = st.session_state.history_str[:cut]
+    st.session_state.history_str = st.session_state.history_str[cut:]
+    st.session_state.history_lengths = lengths[-HISTORY_KEEP_MESSAGES:]
+    try:
+        response = model.generate_content(f"""
+        {ROLLUP_INSTRUCTION}
+
+        **Summary So Far:**
+        {st.session_state.rollup}
+
+        **Conversation:**
+        {older}
+        """)
+        st.session_state.rollup = response.text.strip()
+    except Exception:
+        pass
+
+def _format_number(value):
+    """
+    Formats a statistic for display, dropping the decimals of whole numbers.
+    Integers are formatted exactly, without passing through float.
+    """
+    if isinstance(value, numbers.Integral):
+        return f"{int(value):,}"
+    if not value.is_integer():
+        return f"{round(value, 4):,}"
+    return f"{int(value):,}"
+
+def answer_locally(df, user_question):
+    """
+    Answers simple descriptive questions (row/column counts, column names,
+    basic column statistics) directly with pandas. Returns a response dict in
+    the same shape as Gemini's, or None if the question needs the model.
+    """
+    question = " ".join(user_question.split())
+    if _ROW_COUNT_RE.match(question):
+        answer = f"The dataset has {len(df):,} rows."
+    elif _COLUMN_COUNT_RE.match(question):
+        answer = f"The dataset has {len(df.columns):,} columns."
+    elif _COLUMN_NAMES_RE.match(question):
+        answer = "The columns are: " + ", ".join(f"`{column}`" for column in df.columns)
+    elif match := _COLUMN_STAT_RE.match(question):
+        columns = {str(column).lower(): column for column in df.columns}
+        column = columns.get(match.group("column").lower())
+        if column is None:
+            return None
+        stat = _LOCAL_STATS[match.group("stat").lower()]
+        value = getattr(df[column], stat)()
+        if not isinstance(value, numbers.Integral):
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                return None
+            if value != value:  # NaN, e.g. an empty column
+                return None
+        answer = f"The {stat} of `{column}` is {_format_number(value)}."
+    else:
+        return None
+    return {"answer": answer, "python_code": None}
+
+def create_prompt(data_summary, user_question, formatted_history, rollup=""):
+    """
+    Creates a detailed and structured prompt for the Gemini model,
+    including data summary, conversation history, and instructions.
+    Returns a (static_prefix, dynamic_suffix) pair: the prefix is identical
+    on every turn of a session so provider-side prompt caching can reuse it,
+    and only the suffix changes as the conversation grows. The history is the
+    running string kept by append_history, preceded by the rollup of older
+    messages once there is one.
+    """
+    static_prefix = f"""
+    {SYSTEM_INSTRUCTION}
 
     **Data Summary:**
     {data_summary}
+    """
+
+    earlier = f"""
+    **Summary of Earlier Conversation:**
+    {rollup}
+    """ if rollup else ""
 
+    dynamic_suffix = f"""{earlier}
     **Conversation History:**
     {formatted_history}
 
     **User's Latest Question:**
     {user_question}
-
-    **Your Task & Instructions:**
-    1.  Provide a clear, concise text answer to the user's question in the "answer" field.
-    2.  If the question can be better answered with a visualization, generate the necessary Python code to create it using the Plotly library. The dataframe is available as a variable named `df`. Place this code in the "python_code" field.
-    3.  The Python code must create a Plotly figure object named 'fig'. For example: `import plotly.express as px; fig = px.bar(df, ...)`
-    4.  Return your response as a single, valid JSON object with two keys: "answer" (string) and "python_code" (string, or null if no chart is needed).
     """
-    return prompt
+    return static_prefix, dynamic_suffix
 
 # --- Main Application Logic ---
 
@@ -97,10 +846,24 @@ with st.sidebar:
     """)
 
 # Initialize session state for chat history and dataframe
-if "messages" not in st.session_state:
-    st.session_state.messages = []
+if "roles" not in st.session_state:
+    st.session_state.roles = []
+    st.session_state.contents = []
+    st.session_state.charts = []
+if "history_str" not in st.session_state:
+    st.session_state.history_str = ""
+    st.session_state.history_lengths = []
+    st.session_state.rollup = ""
 if "dataframe" not in st.session_state:
     st.session_state.dataframe = None
+if "data_summary" not in st.session_state:
+    st.session_state.data_summary = None
+if "df_fingerprint" not in st.session_state:
+    st.session_state.df_fingerprint = None
+if "prefetch" not in st.session_state:
+    st.session_state.prefetch = None
+if "cached_model" not in st.session_state:
+    _forget_cached_context()
 
 # File uploader
 uploaded_file = st.file_uploader("Upload your CSV file to get started", type="csv", label_visibility="collapsed")
@@ -109,70 +872,131 @@ if uploaded_file is not None:
     # Read and store the dataframe in session state if it's not already there
     if st.session_state.dataframe is None:
         try:
-            df = pd.read_csv(uploaded_file)
+            raw_bytes = uploaded_file.getvalue()
+            df = _load_csv(raw_bytes)
             st.session_state.dataframe = df
+            st.session_state.df_fingerprint = upload_fingerprint(raw_bytes)
+            st.session_state.data_summary = build_data_summary(df, st.session_state.df_fingerprint)
+            create_cached_context(st.session_state.data_summary, st.session_state.df_fingerprint)
             # Clear previous chat history when a new file is uploaded
-            st.session_state.messages = []
+            st.session_state.roles = []
+            st.session_state.contents = []
+            st.session_state.charts = []
+            st.session_state.history_str = ""
+            st.session_state.history_lengths = []
+            st.session_state.rollup = ""
+            cancel_prefetch()
             st.success("File uploaded successfully! Here's a preview of your data:", icon="✅")
             st.dataframe(df.head())
         except Exception as e:
             st.error(f"Error reading the file: {e}", icon="❌")
             st.session_state.dataframe = None
+            st.session_state.data_summary = None
+            st.session_state.df_fingerprint = None
 
 # Main chat interface logic
 if st.session_state.dataframe is not None:
     df = st.session_state.dataframe
     
     # Display existing chat messages
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
-            if "chart" in message and message["chart"] is not None:
-                st.plotly_chart(message["chart"], use_container_width=True)
+    for role, content, chart in zip(
+        st.session_state.roles, st.session_state.contents, st.session_state.charts
+    ):
+        with st.chat_message(role):
+            st.markdown(content)
+            if chart is not None:
+                st.plotly_chart(figure_from_json(chart), use_container_width=True)
                 
+    # Offer the predicted next question, answered ahead of time, as a one-click suggestion
+    suggestion_slot = st.empty()
+    suggested_prompt = None
+    if st.session_state.prefetch is not None and not st.session_state.prefetch.done():
+        _await_prefetch()
+    elif (suggestion := prefetched_question()) and suggestion_slot.button(
+        f"💡 {suggestion}", key="followup_suggestion"
+    ):
+        suggested_prompt = suggestion
+
     # Get new user input
-    if prompt := st.chat_input("Ask a question about your data..."):
+    if prompt := st.chat_input("Ask a question about your data...") or suggested_prompt:
+        suggestion_slot.empty()
         # Add user message to history and display it
-        st.session_state.messages.append({"role": "user", "content": prompt})
+        add_message("user", prompt)
         with st.chat_message("user"):
             st.markdown(prompt)
 
+        # Simple descriptive questions are answered locally without any API call
+        local_response = answer_locally(df, prompt)
+
         # Generate the full prompt for the model
-        full_prompt = create_prompt(df, prompt, st.session_state.messages)
+        static_prefix, dynamic_suffix = create_prompt(
+            st.session_state.data_summary, prompt, st.session_state.history_str, st.session_state.rollup
+        )
+        cache_key = make_response_key(
+            st.session_state.df_fingerprint, prompt, st.session_state.roles, st.session_state.contents
+        )
+        # The response cache is checked before any prefetched answer
+        cached_response = None if local_response else lookup_cached_response(cache_key)
+        prefetched = take_prefetched_response(prompt)
+        if prefetched and not (local_response or cached_response):
+            _store_cached_response(cache_key, prefetched)
+        append_history("user", prompt)
+        active_model = None if local_response else get_active_model()
+        # A context cache already holds the static prefix
+        if active_model is model:
+            full_prompt = static_prefix + dynamic_suffix
+        else:
+            full_prompt = dynamic_suffix
+
+        # Load Plotly in the background while waiting on the API
+        _prewarm_plotly()
 
-        # Get response from Gemini
-        with st.spinner("Analyzing and generating response..."):
-            response_data = get_gemini_response(full_prompt)
+        # Get response from Gemini, streaming the answer as it arrives
+        with st.chat_message("assistant"):
+            placeholder = st.empty()
+            with st.spinner("Analyzing and generating response..."):
+                response_data = (
+                    local_response or cached_response or prefetched
+                    or get_gemini_response(full_prompt, active_model, cache_key, placeholder)
+                )
 
+            fig = None
             if response_data:
                 answer = response_data.get("answer", "I couldn't find a text answer.")
                 python_code = response_data.get("python_code")
-                fig = None
 
                 # If there's python code, execute it to generate a chart
                 if python_code:
                     try:
                         # SECURITY WARNING: exec() can be dangerous.
-                        # It's used here to run AI-generated code.
-                        local_scope = {"df": df, "st": st}
-                        exec(python_code, globals(), local_scope)
-                        fig = local_scope.get('fig')
+                        # It's used here to run AI-generated code. The code is
+                        # screened and runs with restricted builtins, which
+                        # catches common mistakes but is not a sandbox.
+                        code = _compile_chart_code(python_code)
+                        px, go = _prewarm_plotly().result()
+                        scope = {"__builtins__": _chart_builtins(), "df": df, "pd": pd, "px": px, "go": go}
+                        exec(code, scope)
+                        fig = scope.get('fig')
                     except Exception as e:
                         st.error(f"Error executing generated Python code: {e}", icon="🐍")
                         answer += "\n\n_Note: I tried to generate a chart but encountered an error._"
-                
+
                 # Display the model's text answer and the chart (if created)
-                with st.chat_message("assistant"):
-                    st.markdown(answer)
-                    if fig:
-                        st.plotly_chart(fig, use_container_width=True)
-                
-                # Add the complete assistant response to chat history
-                st.session_state.messages.append({
-                    "role": "assistant", 
-                    "content": answer, 
-                    "chart": fig
-                })
+                placeholder.markdown(answer)
+                if fig:
+                    st.plotly_chart(fig, use_container_width=True)
+            else:
+                placeholder.empty()
+
+        if response_data:
+            # Add the complete assistant response to chat history
+            append_history("assistant", answer)
+            # The chart is stored as its JSON spec, serialized once instead of on every rerun
+            add_message("assistant", answer, figure_to_json(fig) if fig else None)
+            # Local answers make no API calls; the rollup waits for the next model turn
+            if not local_response:
+                roll_up_history()
+                start_followup_prefetch(active_model)
 
 else:
     st.info("Please upload a CSV file to begin the analysis.")